@@ -4,9 +4,8 @@ from typing import Any
 import tomllib as tl
 import os.path as op
 import log
-import utils
 
-from vault import create_vault, increment_vault, expand_vault
+from vault import create_vault, increment_vault, expand_vault, train_vault_dict
 from dirtools import Dir, DirState, compute_diff
 
 
@@ -40,6 +39,15 @@ def expand(vault_dir: str, vault_to_expand: str, password: str, output_dir: str)
     expand_vault(vault_dir, vault_to_expand, password, output_dir)
 
 
+@chup.command('train-dict', help='Train a zstd dictionary used to compress new vaults. The dictionary is '
+                                   'encrypted with the vault password, which must match the one of the vaults.')
+@clk.option('--vault-dir', '-d', 'vault_dir', help='The directory to store the vault.', default='.')
+@clk.password_option(confirmation_prompt=False)
+@clk.argument('sample_dir', required=True)
+def train_dict(vault_dir: str, password: str, sample_dir: str):
+    train_vault_dict(vault_dir, sample_dir, password)
+
+
 @chup.command('backup', help='Conduct cloud backup.')
 @clk.option('--config', '-c', 'config_path', help='The config file in TOML format.', default='/etc/chup.toml')
 @clk.option('--debug', 'debug', default=None)
@@ -57,20 +65,14 @@ def full_local_backup(config: Config, target_dir: str) -> tuple[str, str]:
     log.info("Starting full backup.")
     with create_vault(target_dir, config.dir_to_backup(), config.password()) as new_vault:
         result = new_vault.result
-
-    with open(result, 'rb') as f:
-        hash_value = utils.hash_file_sha256(f)
-    return result, hash_value
+    return result, new_vault.hash_value
 
 
 def incremental_local_backup(config: Config, target_dir: str, base_backup: str) -> tuple[str, str]:
     log.info(f'Starting incremental backup from base vault file {base_backup}.')
     with increment_vault(target_dir, base_backup, config.password(), config.dir_to_backup()) as new_vault:
         result = new_vault.result
-
-    with open(result, 'rb') as f:
-        hash_value = utils.hash_file_sha256(f)
-    return result, hash_value
+    return result, new_vault.hash_value
 
 
 def full_cloud_backup(config: Config):
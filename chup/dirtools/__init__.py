@@ -5,7 +5,7 @@ import hashlib
 from contextlib import closing  # for Python2.6 compatibility
 import tarfile
 import tempfile
-from datetime import datetime
+from datetime import datetime, timezone
 import json
 
 from globster import Globster
@@ -66,6 +66,21 @@ def filehash(filepath, blocksize=4096):
     return sha.hexdigest()
 
 
+def filefingerprint(filepath):
+    """ Return a metadata-only fingerprint for the file `filepath',
+    its size and its modification time in nanoseconds, without reading it.
+
+    :type filepath: str or os.DirEntry
+    :param filepath: Path to file, or its scandir entry (its stat result is cached on the entry)
+
+    :rtype: list
+    :return: [size, mtime_ns], a list so it compares equal after a JSON round trip
+
+    """
+    st = filepath.stat() if isinstance(filepath, os.DirEntry) else os.stat(filepath)
+    return [st.st_size, st.st_mtime_ns]
+
+
 class File(object):
     def __init__(self, path):
         self.file = os.path.basename(path)
@@ -246,23 +261,34 @@ class Dir(object):
         """ Walk the directory like os.path
         (yields a 3-tuple (dirpath, dirnames, filenames)
         except it exclude all files/directories on the fly. """
-        for root, dirs, files in os.walk(self.path, topdown=True):
-            # TODO relative walk, recursive call if root excluder found???
-            #root_excluder = get_root_excluder(root)
-            ndirs = []
-            # First we exclude directories
-            for d in list(dirs):
-                if self.is_excluded(os.path.join(root, d)):
-                    dirs.remove(d)
-                elif not os.path.islink(os.path.join(root, d)):
-                    ndirs.append(d)
-
-            nfiles = []
-            for fpath in (os.path.join(root, f) for f in files):
-                if not self.is_excluded(fpath) and not os.path.islink(fpath):
-                    nfiles.append(os.path.relpath(fpath, root))
-
-            yield root, ndirs, nfiles
+        for root, dirs, files in self.walk_entries():
+            yield root, [d.name for d in dirs], [f.name for f in files]
+
+    def walk_entries(self):
+        """ Like `walk', but yields the os.DirEntry of each subdir and file.
+        The entry types come from scandir without extra lstat calls; stat()
+        on an entry still costs one stat call (on Linux), which is cached on
+        the entry. Symlinks are skipped. """
+        stack = [self.path]
+        while stack:
+            root = stack.pop()
+            dirs = []
+            files = []
+            try:
+                with os.scandir(root) as it:
+                    for entry in it:
+                        if entry.is_symlink() or self.is_excluded(entry.path):
+                            continue
+                        if entry.is_dir():
+                            dirs.append(entry)
+                        else:
+                            files.append(entry)
+            except OSError:
+                # Same as os.walk: unreadable directories are skipped.
+                continue
+
+            yield root, dirs, files
+            stack.extend(reversed([d.path for d in dirs]))
 
     def find_projects(self, file_identifier=".project"):
         """ Search all directory recursively for subdirs
@@ -310,19 +336,37 @@ class Dir(object):
 
 
 class DirState(object):
-    """ Hold a directory state / snapshot meta-data for later comparison. """
-    def __init__(self, _dir=None, state=None, index_cmp=os.path.getmtime):
+    """ Hold a directory state / snapshot meta-data for later comparison.
+
+    Files are indexed with `filefingerprint' by default, so a file counts as
+    updated when its size or nanosecond mtime changes.
+
+    """
+    def __init__(self, _dir=None, state=None, index_cmp=filefingerprint):
         self._dir = _dir
         self.index_cmp = index_cmp
         self.state = state or self.compute_state()
 
     def compute_state(self):
-        """ Generate the index. """
+        """ Generate the index, walking the directory only once. """
+        files = []
+        subdirs = []
+        index = {}
+        for root, dirs, entries in self._dir.walk_entries():
+            for d in dirs:
+                subdirs.append(self._dir.relpath(d.path))
+            for entry in entries:
+                relpath = self._dir.relpath(entry.path)
+                files.append(relpath)
+                try:
+                    index[relpath] = self.index_cmp(entry)
+                except Exception as exc:
+                    print(relpath, exc)
         data = {}
         data['directory'] = self._dir.path
-        data['files'] = list(self._dir.files())
-        data['subdirs'] = list(self._dir.subdirs())
-        data['index'] = self.index()
+        data['files'] = sorted(files)
+        data['subdirs'] = sorted(subdirs)
+        data['index'] = index
         return data
 
     def index(self):
@@ -352,7 +396,7 @@ class DirState(object):
         if fmt is None:
             fmt = '{0}@{1}.json'
         if dt is None:
-            dt = datetime.utcnow()
+            dt = datetime.now(tz=timezone.utc)
         path = fmt.format(self._dir.path.strip('/').split('/')[-1],
                           dt.isoformat())
         path = os.path.join(base_path, path)
@@ -376,15 +420,25 @@ def compute_diff(dir_base, dir_cmp):
      - updated files `updated'
      - deleted directories `deleted_dirs'
 
+    Each file list is built in a single pass over the (sorted) file lists
+    of the states, so the files keep their order.
+
     """
+    base_files = set(dir_base['files'])
+    cmp_files = set(dir_cmp['files'])
+    base_index = dir_base['index']
+    cmp_index = dir_cmp['index']
+
     data = {}
-    data['deleted'] = list(set(dir_cmp['files']) - set(dir_base['files']))
-    data['created'] = list(set(dir_base['files']) - set(dir_cmp['files']))
+    data['deleted'] = [f for f in dir_cmp['files'] if f not in base_files]
+    data['created'] = []
     data['updated'] = []
     data['deleted_dirs'] = list(set(dir_cmp['subdirs']) - set(dir_base['subdirs']))
 
-    for f in set(dir_cmp['files']).intersection(set(dir_base['files'])):
-        if dir_base['index'][f] != dir_cmp['index'][f]:
+    for f in dir_base['files']:
+        if f not in cmp_files:
+            data['created'].append(f)
+        elif base_index[f] != cmp_index[f]:
             data['updated'].append(f)
 
     return data
\ No newline at end of file
@@ -0,0 +1,46 @@
+import os
+import shutil
+import subprocess
+from typing import IO
+
+_COMMON_ARGS = ['--batch', '--yes', '--quiet', '--no-tty', '--pinentry-mode', 'loopback']
+
+
+def _gpg() -> str:
+    path = shutil.which('gpg')
+    if path is None:
+        raise FileNotFoundError('gpg executable not found in PATH')
+    return path
+
+
+def _passphrase_fd(password: str) -> int:
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(write_fd, 'w') as f:
+        f.write(password)
+    return read_fd
+
+
+def encrypt(dst: IO[bytes], password: str, cipher_algo: str) -> subprocess.Popen:
+    """Start a gpg process that symmetrically encrypts its stdin into `dst`.
+
+    The input is expected to be compressed already, so gpg's own compression is turned off.
+    """
+    passphrase_fd = _passphrase_fd(password)
+    try:
+        return subprocess.Popen([_gpg(), *_COMMON_ARGS, '--passphrase-fd', str(passphrase_fd),
+                                 '--symmetric', '--cipher-algo', cipher_algo, '--compress-algo', 'none',
+                                 '--output', '-'],
+                                stdin=subprocess.PIPE, stdout=dst, pass_fds=(passphrase_fd,))
+    finally:
+        os.close(passphrase_fd)
+
+
+def decrypt(dst: IO[bytes], password: str) -> subprocess.Popen:
+    """Start a gpg process that decrypts its stdin into `dst`."""
+    passphrase_fd = _passphrase_fd(password)
+    try:
+        return subprocess.Popen([_gpg(), *_COMMON_ARGS, '--passphrase-fd', str(passphrase_fd),
+                                 '--decrypt', '--output', '-'],
+                                stdin=subprocess.PIPE, stdout=dst, pass_fds=(passphrase_fd,))
+    finally:
+        os.close(passphrase_fd)
@@ -1,14 +1,119 @@
+import copy
 import hashlib
+import io
+import os
+import shutil
+import subprocess
+import tarfile
 from typing import BinaryIO
 
-_BUFFER_SIZE = 32768
+COPY_BUFFER_SIZE = 2 * 1024 * 1024
 
 
-def hash_file_sha256(file: BinaryIO) -> str:
-    sha256 = hashlib.sha256()
-    while True:
-        data = file.read(_BUFFER_SIZE)
-        if not data:
-            break
-        sha256.update(data)
-    return sha256.hexdigest()
+def hash_file(file: BinaryIO, algorithm: str = 'sha256') -> str:
+    return hashlib.file_digest(file, algorithm).hexdigest()
+
+
+class HashingWriter:
+    """Write-through wrapper around a binary file that hashes everything written to it."""
+
+    def __init__(self, file: BinaryIO, algorithm: str = 'sha256'):
+        self.__file = file
+        self.__hash = hashlib.new(algorithm)
+
+    def write(self, data) -> int:
+        self.__hash.update(data)
+        return self.__file.write(data)
+
+    def tell(self) -> int:
+        return self.__file.tell()
+
+    def flush(self):
+        self.__file.flush()
+
+    def close(self):
+        self.__file.close()
+
+    def hexdigest(self) -> str:
+        return self.__hash.hexdigest()
+
+
+def wait_process(process: subprocess.Popen):
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+
+def _is_real_file(file) -> bool:
+    return isinstance(getattr(file, 'raw', file), io.FileIO)
+
+
+def copyfileobj(src: BinaryIO, dst: BinaryIO, length: int, exception: type = OSError):
+    """Copy `length` bytes from `src` to `dst`, in the kernel with sendfile when both are real files.
+
+    Raises `exception` if `src` ends early, like `tarfile.copyfileobj`.
+    """
+    if not (_is_real_file(src) and _is_real_file(dst)):
+        tarfile.copyfileobj(src, dst, length, exception=exception, bufsize=COPY_BUFFER_SIZE)
+        return
+    dst.flush()
+    start = offset = src.tell()
+    end = start + length
+    while offset < end:
+        try:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset, min(end - offset, COPY_BUFFER_SIZE))
+        except OSError:
+            if offset != start:
+                raise
+            # Not sendfile-capable (e.g. a pipe as the source), copy through user space instead.
+            tarfile.copyfileobj(src, dst, length, exception=exception, bufsize=COPY_BUFFER_SIZE)
+            return
+        if sent == 0:
+            raise exception('unexpected end of data')
+        offset += sent
+    src.seek(end)
+
+
+def copyfileobj_to_end(src: BinaryIO, dst: BinaryIO):
+    """Copy the rest of `src` to `dst`, in the kernel with sendfile when both are real files."""
+    if _is_real_file(src) and _is_real_file(dst):
+        copyfileobj(src, dst, os.fstat(src.fileno()).st_size - src.tell())
+    else:
+        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+
+class TarFile(tarfile.TarFile):
+    """A PAX TarFile whose member data is copied in and out with `copyfileobj` and a large buffer."""
+
+    def __init__(self, *args, format: int = tarfile.PAX_FORMAT, copybufsize: int = COPY_BUFFER_SIZE, **kwargs):
+        super().__init__(*args, format=format, copybufsize=copybufsize, **kwargs)
+
+    @classmethod
+    def open(cls, *args, bufsize: int = COPY_BUFFER_SIZE, **kwargs):
+        # bufsize only matters for the stream modes ('r|', 'w|', ...), where it replaces the 10 KiB default record
+        # buffer, so every write to the underlying pipe or file moves a large block.
+        return super().open(*args, bufsize=bufsize, **kwargs)
+
+    def addfile(self, tarinfo, fileobj=None):
+        if fileobj is None:
+            super().addfile(tarinfo)
+            return
+        self._check('awx')
+        tarinfo = copy.copy(tarinfo)
+        buf = tarinfo.tobuf(self.format, self.encoding, self.errors)
+        self.fileobj.write(buf)
+        self.offset += len(buf)
+        copyfileobj(fileobj, self.fileobj, tarinfo.size)
+        blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+        if remainder > 0:
+            self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        self.offset += blocks * tarfile.BLOCKSIZE
+        self.members.append(tarinfo)
+
+    def makefile(self, tarinfo, targetpath):
+        if tarinfo.sparse is not None:
+            super().makefile(tarinfo, targetpath)
+            return
+        self.fileobj.seek(tarinfo.offset_data)
+        with open(targetpath, 'wb') as target:
+            copyfileobj(self.fileobj, target, tarinfo.size, tarfile.ReadError)
@@ -1,32 +1,140 @@
-import base64
+import hashlib
 import json
+import math
 import os
 import shutil
+import struct
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from enum import Enum
 from io import BytesIO
-from tarfile import TarFile
-from tempfile import NamedTemporaryFile, TemporaryDirectory
-from typing import Optional, IO
+from tarfile import TarInfo
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile, TemporaryDirectory, TemporaryFile
+from threading import Thread
+from typing import Optional, IO, Iterator
 import os.path as op
-from datetime import datetime
+from datetime import datetime, timezone
 import log
 import gnupg
 import pyrsync
+import gpg
 import zstd
 import utils
 from dirtools import Dir, DirState
 
-_DEFAULT_GPG_ALG = 'CAST5'
+# AES is hardware accelerated (AES-NI) on current CPUs, unlike CAST5. gpg reads the cipher from the packets
+# when decrypting; the reader only checks the cipher recorded in the metadata is one it supports.
+_DEFAULT_GPG_ALG = 'AES256'
+# BLAKE2b is faster than SHA-256 in software. References to a previous vault record the algorithm they used.
+_HASH_ALG = 'blake2b'
+
+# Bumped whenever the layout of the vault members changes. Vaults without a 'format' field in their metadata
+# predate it and use separate list, state and base64 JSON signature members this version cannot read.
+_VAULT_FORMAT = 2
 
 _VAULT_ROOT_PREFIX = 'backup'
 _VAULT_ADD_PREFIX = 'created'
 _VAULT_UPDATE_PREFIX = 'updated'
 
-_VAULT_SIG_FILE = 'sigs.json.gpg'
+_VAULT_SIG_FILE = 'sigs.bin.gpg'
+_VAULT_ZSTD_DICT_FILE = 'zstd.zdict.gpg'
 _VAULT_METADATA_FILE = 'metadata.json.gpg'
-_VAULT_STATE_FILE = 'state.json.gpg'
-_VAULT_FILE_LIST_FILE = 'list.json.gpg'
 _VAULT_DATA_PREFIX = 'data'
+_VAULT_DATA_FILE = f'{_VAULT_DATA_PREFIX}.tar.zst.gpg'
+# Joined once here instead of for every file added to the data tarball.
+_VAULT_ADD_ARC_PREFIX = op.join(_VAULT_DATA_PREFIX, _VAULT_ADD_PREFIX, '')
+_VAULT_UPDATE_ARC_PREFIX = op.join(_VAULT_DATA_PREFIX, _VAULT_UPDATE_PREFIX, '')
+
+# Trained from the files being backed up, so it holds fragments of them and is kept encrypted like the vaults.
+# Each vault stores an encrypted copy of the dictionary it was compressed with, so retraining never affects it.
+_VAULT_DICT_FILE = 'backup.zdict.gpg'
+# Written next to each vault with the hash computed while writing it, so it need not be read back to be hashed.
+_VAULT_HASH_SUFFIX = '.hash'
+
+_DELTA_SPOOL_SIZE = 8 * 1024 * 1024
+_READ_BUFFER_SIZE = 1024 * 1024
+
+# The block length is recorded in each signature's header, so it can differ from file to file.
+_MIN_SIG_BLOCK_LEN = 2048
+_MAX_SIG_BLOCK_LEN = 65536
+_SIG_STRONG_LEN = 4
+
+# Each signature is stored as <name length><signature length><name><signature>.
+_SIG_HEADER = struct.Struct('<II')
+
+# librsync delta format: the delta magic, then opcodes; COPY_N8_N8 is followed by an 8-byte offset and length.
+_DELTA_MAGIC = struct.pack('>I', pyrsync.RS_DELTA_MAGIC)
+_DELTA_OP_END = 0x00
+_DELTA_OP_COPY_N8_N8 = 0x54
+_DELTA_END = _DELTA_MAGIC + bytes([_DELTA_OP_END])
+
+
+def _pack_sigs(sigs: dict[str, bytes | memoryview]) -> bytes:
+    chunks = []
+    for file, sig in sigs.items():
+        name = os.fsencode(file)
+        chunks += [_SIG_HEADER.pack(len(name), len(sig)), name, sig]
+    return b''.join(chunks)
+
+
+def _unpack_sigs(data: bytes) -> dict[str, memoryview]:
+    # Signatures are slices of the one decrypted buffer rather than a separate bytes object each.
+    sigs = {}
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        name_len, sig_len = _SIG_HEADER.unpack_from(view, offset)
+        offset += _SIG_HEADER.size
+        name = os.fsdecode(view[offset:offset + name_len].tobytes())
+        offset += name_len
+        sigs[name] = view[offset:offset + sig_len]
+        offset += sig_len
+    return sigs
+
+
+def _signature_block_len(file_size: int) -> int:
+    # sqrt(size) balances signature size against delta granularity, as librsync recommends.
+    return max(_MIN_SIG_BLOCK_LEN, min(_MAX_SIG_BLOCK_LEN, math.isqrt(file_size)))
+
+
+def _file_signature(original_file: IO[bytes]) -> bytes:
+    block_len = _signature_block_len(os.fstat(original_file.fileno()).st_size)
+    with BytesIO() as sig_file:
+        pyrsync.signature(original_file, sig_file, _SIG_STRONG_LEN, pyrsync.RS_RK_BLAKE2_SIG_MAGIC, block_len)
+        return sig_file.getvalue()
+
+
+def _unchanged_delta(file_size: int) -> bytes:
+    """A delta that copies the whole old file, as librsync produces for a file that did not change."""
+    if file_size == 0:
+        return _DELTA_END
+    return _DELTA_MAGIC + bytes([_DELTA_OP_COPY_N8_N8]) + struct.pack('>QQ', 0, file_size) + bytes([_DELTA_OP_END])
+
+
+def _signature(path: str) -> bytes:
+    with open(path, 'rb', buffering=_READ_BUFFER_SIZE) as original_file:
+        return _file_signature(original_file)
+
+
+def _write_hash_sidecar(vault_path: str, algorithm: str, hash_value: str):
+    st = os.stat(vault_path)
+    with open(vault_path + _VAULT_HASH_SUFFIX, 'w') as f:
+        json.dump({'hash_algo': algorithm, 'hash': hash_value, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}, f)
+
+
+def _read_hash_sidecar(vault_path: str, vault_file: IO[bytes], algorithm: str) -> Optional[str]:
+    try:
+        with open(vault_path + _VAULT_HASH_SUFFIX) as f:
+            sidecar = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # Only trusted while the vault still has the size and mtime it had when the hash was recorded.
+    st = os.fstat(vault_file.fileno())
+    if sidecar.get('hash_algo') != algorithm or sidecar.get('size') != st.st_size \
+            or sidecar.get('mtime_ns') != st.st_mtime_ns:
+        return None
+    return sidecar.get('hash')
 
 
 class VaultType(Enum):
@@ -36,18 +144,45 @@ class VaultType(Enum):
 
 class VaultWriter:
     def __init__(self, vault_dir: str, backup_dir: str, password: str,
-                 previous_vault: Optional[tuple[str, str, dict[str, bytes], set[str]]] = None, id: str = None):
+                 previous_vault: Optional[tuple[str, str, dict[str, bytes | memoryview], set[str]]] = None,
+                 id: str = None, dir_state: Optional[DirState] = None):
+        self.__password = password
+        self.__gpg = gnupg.GPG()
+        trained_dictionary = op.join(vault_dir, _VAULT_DICT_FILE)
+        if op.exists(trained_dictionary):
+            # Read once, so the hash and the stored copy agree even if the dictionary is retrained meanwhile.
+            with open(trained_dictionary, 'rb') as f:
+                decrypted = self.__gpg.decrypt(f.read(), passphrase=password)
+            if not decrypted.ok:
+                raise ValueError(f'Failed to decrypt the zstd dictionary {trained_dictionary}: {decrypted.status}')
+            self.__dictionary: Optional[bytes] = decrypted.data
+            self.__dict_hash = hashlib.new(_HASH_ALG, self.__dictionary).hexdigest()
+        else:
+            self.__dictionary = None
+            self.__dict_hash = None
         self.__backup_dir = backup_dir
-        self.__timestamp = datetime.utcnow()
+        # Files are opened relative to this descriptor so each open doesn't resolve the whole path again.
+        self.__backup_dir_fd = os.open(backup_dir, os.O_RDONLY | os.O_DIRECTORY)
+        self.__dir_state = dir_state
+        self.__timestamp = datetime.now(tz=timezone.utc)
+        self.__timestamp_str = self.__timestamp.isoformat()
         if id is None:
-            self.__id = self.__timestamp.isoformat()
+            self.__id = self.__timestamp_str
         else:
             self.__id = id
-        self.__vault_path = op.join(vault_dir, f'{self.__timestamp.isoformat()}.tar')
-        self.__tarball = TarFile.open(self.__vault_path, mode='w')
-        self.__password = password
-        self.__tmp_dir = TemporaryDirectory()
-        self.__data_tarball = TarFile.open(op.join(self.__tmp_dir.name, 'data.tar'), mode='w')
+        self.__vault_path = op.join(vault_dir, f'{self.__timestamp_str}.tar')
+        # Hash the vault while it is written instead of reading it back afterwards.
+        self.__vault_file = utils.HashingWriter(open(self.__vault_path, 'wb'), _HASH_ALG)
+        self.__tarball = utils.TarFile.open(fileobj=self.__vault_file, mode='w')
+        self.__hash_value: Optional[str] = None
+        # tar | zstd | gpg, so neither data.tar nor data.tar.zst ever hit the disk. Only the encrypted result
+        # is kept, in an anonymous file, until its size is known and it can be added to the vault tarball.
+        self.__data_file = TemporaryFile(mode='w+b')
+        self.__gpg_process = gpg.encrypt(self.__data_file, password, _DEFAULT_GPG_ALG)
+        self.__zstd_file = zstd.compress_stream(self.__gpg_process.stdin, dictionary=self.__dictionary)
+        self.__data_tarball = utils.TarFile.open(fileobj=self.__zstd_file, mode='w|')
+        # Reused by every update() so deltas don't each need a fresh temporary file.
+        self.__delta_file = SpooledTemporaryFile(max_size=_DELTA_SPOOL_SIZE, mode='w+b')
         if previous_vault is None:
             self.__type = VaultType.FULL
             self.__sigs = {}
@@ -65,7 +200,7 @@ class VaultWriter:
 
     @property
     def timestamp(self):
-        return self.__timestamp.isoformat()
+        return self.__timestamp_str
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
@@ -74,155 +209,205 @@ class VaultWriter:
     def result(self):
         return self.__vault_path
 
-    def create(self, file: str):
+    @property
+    def hash_value(self) -> Optional[str]:
+        return self.__hash_value
+
+    def __open(self, file: str) -> IO[bytes]:
+        fd = os.open(file, os.O_RDONLY, dir_fd=self.__backup_dir_fd)
+        return os.fdopen(fd, 'rb', buffering=_READ_BUFFER_SIZE)
+
+    def create(self, file: str, sig: Optional[bytes] = None):
         log.info(f'Adding file {file} to vault {self.id}')
-        self.__data_tarball.add(op.join(self.__backup_dir, file),
-                                arcname=op.join(_VAULT_DATA_PREFIX, _VAULT_ADD_PREFIX, file))
-        with open(op.join(self.__backup_dir, file), 'rb') as original_file, BytesIO() as sig_file:
-            pyrsync.signature(original_file, sig_file, 4, pyrsync.RS_RK_BLAKE2_SIG_MAGIC)
-            sig_file.seek(0)
-            self.__sigs[file] = sig_file.read()
-            self.__file_list.add(file)
+        with self.__open(file) as original_file:
+            data_tarball = self.__data_tarball
+            tarinfo = data_tarball.gettarinfo(arcname=_VAULT_ADD_ARC_PREFIX + file, fileobj=original_file)
+            data_tarball.addfile(tarinfo, original_file)
+            if sig is None:
+                original_file.seek(0)
+                sig = _file_signature(original_file)
+        self.__sigs[file] = sig
+        self.__file_list.add(file)
 
     @property
     def id(self):
         return self.__id
 
-    def update(self, file: str):
+    def update(self, file: str, sig: Optional[bytes] = None):
         log.info(f'Updating file {file} in vault {self.id}')
-        with (open(op.join(self.__backup_dir, file), 'rb') as original_file,
-              NamedTemporaryFile(mode='w+b') as delta_file,
-              BytesIO() as new_sig_file,
-              BytesIO() as old_sig_file):
-            old_sig = self.__sigs[file]
-            old_sig_file.write(old_sig)
-            old_sig_file.seek(0)
-            pyrsync.delta(original_file, old_sig_file, delta_file)
+        delta_file = self.__delta_file
+        delta_file.seek(0)
+        delta_file.truncate()
+        old_sig = self.__sigs[file]
+        with self.__open(file) as original_file:
+            if sig == old_sig:
+                # Touched but not changed: the delta is a plain copy of the old file, so skip computing it.
+                delta_file.write(_unchanged_delta(os.fstat(original_file.fileno()).st_size))
+            else:
+                with BytesIO(old_sig) as old_sig_file:
+                    pyrsync.delta(original_file, old_sig_file, delta_file)
+            tarinfo = TarInfo(_VAULT_UPDATE_ARC_PREFIX + file)
+            tarinfo.size = delta_file.tell()
+            tarinfo.mtime = os.fstat(original_file.fileno()).st_mtime
             delta_file.seek(0)
-            original_file.seek(0)
-            self.__data_tarball.add(delta_file.name, arcname=op.join(_VAULT_DATA_PREFIX, _VAULT_UPDATE_PREFIX, file))
-            pyrsync.signature(original_file, new_sig_file, 4, pyrsync.RS_RK_BLAKE2_SIG_MAGIC)
-            new_sig_file.seek(0)
-            self.__sigs[file] = new_sig_file.read()
+            self.__data_tarball.addfile(tarinfo, delta_file)
+            if sig is None:
+                original_file.seek(0)
+                sig = _file_signature(original_file)
+        self.__sigs[file] = sig
 
     def delete(self, file: str):
         log.info(f'Deleting file {file} from vault {self.id}')
         self.__sigs.pop(file)
         self.__file_list.remove(file)
 
+    def __add_encrypted(self, name: str, data: bytes):
+        encrypted = self.__gpg.encrypt(data, recipients=None, passphrase=self.__password, symmetric=_DEFAULT_GPG_ALG,
+                                       armor=False)
+        if not encrypted.ok:
+            raise ValueError(f'Failed to encrypt {name}: {encrypted.status}')
+        tarinfo = TarInfo(op.join(_VAULT_ROOT_PREFIX, name))
+        tarinfo.size = len(encrypted.data)
+        tarinfo.mtime = self.__timestamp.timestamp()
+        self.__tarball.addfile(tarinfo, BytesIO(encrypted.data))
+
     def close(self):
         log.info(f'Saving vault {self.id}')
-        metadata = {'id': self.id, 'timestamp': self.timestamp, 'type': self.__type.value,
-                    'dir_name': self.__backup_dir.strip('/').split('/')[-1]}
+        metadata = {'format': _VAULT_FORMAT, 'id': self.id, 'timestamp': self.timestamp, 'type': self.__type.value,
+                    'dir_name': self.__backup_dir.strip('/').split('/')[-1], 'cipher': _DEFAULT_GPG_ALG}
         if self.__type == VaultType.INCREMENTAL:
             metadata['previous_vault'] = {'file_name': op.basename(self.__previous_vault_path),
-                                          'hash': self.__previous_vault_hash}
-        with NamedTemporaryFile(mode='w+t') as metadata_file:
-            json.dump(metadata, metadata_file)
-            metadata_file.seek(0)
-            with NamedTemporaryFile(mode='w+b') as tmp:
-                gnupg.GPG().encrypt(metadata_file.read(), recipients=None, passphrase=self.__password, output=tmp.name,
-                                    symmetric=_DEFAULT_GPG_ALG)
-                tmp.seek(0)
-                self.__tarball.add(tmp.name, arcname=op.join(_VAULT_ROOT_PREFIX, _VAULT_METADATA_FILE))
-
-        with NamedTemporaryFile(mode='w+t') as file_list_file:
-            json.dump(list(self.__file_list), file_list_file)
-            file_list_file.seek(0)
-            with NamedTemporaryFile(mode='w+b') as tmp:
-                gnupg.GPG().encrypt(file_list_file.read(), recipients=None, passphrase=self.__password, output=tmp.name,
-                                    symmetric=_DEFAULT_GPG_ALG)
-                tmp.seek(0)
-                self.__tarball.add(tmp.name, arcname=op.join(_VAULT_ROOT_PREFIX, _VAULT_FILE_LIST_FILE))
-
-        sigs_list = [{'file': k, 'sig': base64.encodebytes(v).decode('ascii')} for k, v in self.__sigs.items()]
-        with NamedTemporaryFile(mode='w+t') as sigs_file:
-            json.dump(sigs_list, sigs_file)
-            sigs_file.seek(0)
-            with NamedTemporaryFile(mode='w+b') as tmp:
-                gnupg.GPG().encrypt(sigs_file.read(), recipients=None, passphrase=self.__password, output=tmp.name,
-                                    symmetric=_DEFAULT_GPG_ALG)
-                tmp.seek(0)
-                self.__tarball.add(tmp.name, arcname=op.join(_VAULT_ROOT_PREFIX, _VAULT_SIG_FILE))
-
-        dir_state = DirState(Dir(self.__backup_dir))
-        with TemporaryDirectory() as tmp_dir:
-            dir_state.to_json(tmp_dir, self.__timestamp, fmt='state.json')
-            with NamedTemporaryFile(mode='w+b') as tmp:
-                gnupg.GPG().encrypt_file(op.join(tmp_dir, 'state.json'), recipients=None, passphrase=self.__password,
-                                         output=tmp.name, symmetric=_DEFAULT_GPG_ALG)
-                tmp.seek(0)
-                self.__tarball.add(tmp.name, arcname=op.join(_VAULT_ROOT_PREFIX, _VAULT_STATE_FILE))
-
+                                          'hash': self.__previous_vault_hash, 'hash_algo': _HASH_ALG}
+        if self.__dict_hash is not None:
+            metadata['zstd_dict'] = self.__dict_hash
+        # The file list and directory state are always read together with the metadata, so they share one
+        # encrypted member and vault open costs a single gpg run.
+        metadata['files'] = list(self.__file_list)
+        dir_state = self.__dir_state if self.__dir_state is not None else DirState(Dir(self.__backup_dir))
+        metadata['state'] = dir_state.state
+        self.__add_encrypted(_VAULT_METADATA_FILE, json.dumps(metadata).encode())
+        self.__add_encrypted(_VAULT_SIG_FILE, _pack_sigs(self.__sigs))
+        if self.__dictionary is not None:
+            self.__add_encrypted(_VAULT_ZSTD_DICT_FILE, self.__dictionary)
+
+        log.info('Compressing and encrypting data tarball')
+        self.__delta_file.close()
+        os.close(self.__backup_dir_fd)
         self.__data_tarball.close()
-
-        log.info('Compressing data tarball')
-        zstd.compress(self.__data_tarball.name, op.join(self.__tmp_dir.name, f'{_VAULT_DATA_PREFIX}.tar.zst'))
-
-        log.info('Encrypting data tarball')
-        gnupg.GPG().encrypt_file(op.join(self.__tmp_dir.name, f'{_VAULT_DATA_PREFIX}.tar.zst'), recipients=None,
-                                 passphrase=self.__password,
-                                 output=op.join(self.__tmp_dir.name, f'{_VAULT_DATA_PREFIX}.tar.zst.gpg'),
-                                 symmetric=_DEFAULT_GPG_ALG)
+        self.__zstd_file.close()
+        self.__gpg_process.stdin.close()
+        utils.wait_process(self.__gpg_process)
 
         log.info('Adding data tarball to vault tarball')
-        self.__tarball.add(op.join(self.__tmp_dir.name, f'{_VAULT_DATA_PREFIX}.tar.zst.gpg'),
-                           arcname=op.join(_VAULT_ROOT_PREFIX, f'{_VAULT_DATA_PREFIX}.tar.zst.gpg'))
+        with self.__data_file as data_file:
+            tarinfo = TarInfo(op.join(_VAULT_ROOT_PREFIX, _VAULT_DATA_FILE))
+            tarinfo.size = os.fstat(data_file.fileno()).st_size
+            tarinfo.mtime = self.__timestamp.timestamp()
+            data_file.seek(0)
+            self.__tarball.addfile(tarinfo, data_file)
         self.__tarball.close()
-        self.__tmp_dir.cleanup()
+        self.__vault_file.close()
+        self.__hash_value = self.__vault_file.hexdigest()
+        _write_hash_sidecar(self.__vault_path, _HASH_ALG, self.__hash_value)
 
 
 class VaultReader:
     def __init__(self, vault_file: str, password: str):
         log.info(f'Loading vault file {vault_file}')
-        with open(vault_file, 'rb') as f:
-            self.__hash_value = utils.hash_file_sha256(f)
-        self.__tarball = TarFile(vault_file, mode='r')
+        # Open the vault once and use the same handle for hashing and for reading the tarball.
+        self.__vault_file = open(vault_file, 'rb')
+        # Hashed on demand: only the vaults referenced by another one need it.
+        self.__hash_values: dict[str, str] = {}
+        self.__tarball = utils.TarFile(fileobj=self.__vault_file, mode='r')
         self.__password = password
+        self.__gpg = gnupg.GPG()
         self.__tmp_dir = TemporaryDirectory()
-        self.__tmp_dir_with_root = op.join(self.__tmp_dir.name, _VAULT_ROOT_PREFIX)
+        self.__file_name = vault_file
 
-        self.__tarball.extract(op.join(_VAULT_ROOT_PREFIX, _VAULT_METADATA_FILE), path=self.__tmp_dir.name)
-        metadata = json.loads(str(gnupg.GPG().decrypt_file(op.join(self.__tmp_dir_with_root, _VAULT_METADATA_FILE),
-                                                           passphrase=password)))
+        metadata = json.loads(self.__decrypt(_VAULT_METADATA_FILE))
+        vault_format = metadata.get('format', 1)
+        if vault_format != _VAULT_FORMAT:
+            raise ValueError(f'Vault {vault_file} has format {vault_format}, but only format {_VAULT_FORMAT} '
+                             f'is supported')
+        if metadata['cipher'] != _DEFAULT_GPG_ALG:
+            raise ValueError(f'Vault {vault_file} is encrypted with {metadata["cipher"]}, but only {_DEFAULT_GPG_ALG} '
+                             f'is supported')
         self.__type = VaultType(metadata['type'])
         self.__timestamp = datetime.fromisoformat(metadata['timestamp'])
         self.__dir_name = metadata['dir_name']
         self.__id = metadata['id']
-        self.__file_name = vault_file
+        self.__dict_hash: Optional[str] = metadata.get('zstd_dict')
         if self.__type == VaultType.FULL:
-            self.__previous_vault: Optional[tuple[str, str]] = None
+            self.__previous_vault: Optional[tuple[str, str, str]] = None
         else:
-            self.__previous_vault = (metadata['previous_vault']['file_name'], metadata['previous_vault']['hash'])
-
-        self.__tarball.extract(op.join(_VAULT_ROOT_PREFIX, _VAULT_SIG_FILE), path=self.__tmp_dir.name)
-        sigs = json.loads(str(gnupg.GPG().decrypt_file(op.join(self.__tmp_dir_with_root, _VAULT_SIG_FILE),
-                                                       passphrase=password)))
-        self.__sigs = {x['file']: base64.decodebytes(x['sig'].encode('ascii')) for x in sigs}
-
-        self.__tarball.extract(op.join(_VAULT_ROOT_PREFIX, _VAULT_FILE_LIST_FILE), path=self.__tmp_dir.name)
-        file_list = json.loads(str(gnupg.GPG().decrypt_file(op.join(self.__tmp_dir_with_root, _VAULT_FILE_LIST_FILE),
-                                                            passphrase=password)))
-        self.__file_list = set(file_list)
-
-        self.__tarball.extract(op.join(_VAULT_ROOT_PREFIX, _VAULT_STATE_FILE), path=self.__tmp_dir.name)
-        gnupg.GPG().decrypt_file(op.join(self.__tmp_dir_with_root, _VAULT_STATE_FILE),
-                                 output=op.join(self.__tmp_dir_with_root, 'state.json'), passphrase=password)
-        self.__dir_state = DirState.from_json(op.join(self.__tmp_dir_with_root, 'state.json'))
-
-        log.info('Extracting data tarball')
-        self.__tarball.extract(op.join(_VAULT_ROOT_PREFIX, f'{_VAULT_DATA_PREFIX}.tar.zst.gpg'),
-                               path=self.__tmp_dir.name)
-        log.info('Decrypt data tarball')
-        gnupg.GPG().decrypt_file(op.join(self.__tmp_dir_with_root, f'{_VAULT_DATA_PREFIX}.tar.zst.gpg'),
-                                 output=op.join(self.__tmp_dir_with_root, f'{_VAULT_DATA_PREFIX}.tar.zst'),
-                                 passphrase=password)
-        log.info('Decompress data tarball')
-        zstd.decompress(op.join(self.__tmp_dir_with_root, f'{_VAULT_DATA_PREFIX}.tar.zst'),
-                        op.join(self.__tmp_dir_with_root, f'{_VAULT_DATA_PREFIX}.tar'))
-        self.__data_tarball = TarFile(op.join(self.__tmp_dir_with_root, f'{_VAULT_DATA_PREFIX}.tar'), mode='r')
+            previous_vault = metadata['previous_vault']
+            self.__previous_vault = (previous_vault['file_name'], previous_vault['hash'], previous_vault['hash_algo'])
+
+        # Only needed when this vault is the base of a new increment; loaded on first access.
+        self.__sigs: Optional[dict[str, memoryview]] = None
 
+        self.__file_list = set(metadata['files'])
+        self.__dir_state = DirState(state=metadata['state'])
+
+        # Decrypted on first use: increments only need the metadata, and unfold_all() streams the data instead.
+        self.__data_tarball: Optional[utils.TarFile] = None
+        # Data files are extracted here one at a time by get_path(), or all at once by unfold_all().
         self.__data_unfold: Optional[TemporaryDirectory] = None
+        self.__unfolded_all = False
+
+    def __decrypt(self, name: str) -> bytes:
+        with self.__tarball.extractfile(op.join(_VAULT_ROOT_PREFIX, name)) as f:
+            decrypted = self.__gpg.decrypt(f.read(), passphrase=self.__password)
+        if not decrypted.ok:
+            raise ValueError(f'Failed to decrypt {name} of vault {self.__file_name}: {decrypted.status}')
+        return decrypted.data
+
+    def __feed(self, member: TarInfo, dst: IO[bytes]):
+        try:
+            with self.__tarball.extractfile(member) as src:
+                utils.copyfileobj(src, dst, member.size)
+        except BrokenPipeError:
+            pass
+        finally:
+            dst.close()
+
+    def __load_dictionary(self) -> Optional[bytes]:
+        if self.__dict_hash is None:
+            return None
+        dictionary = self.__decrypt(_VAULT_ZSTD_DICT_FILE)
+        if hashlib.new(_HASH_ALG, dictionary).hexdigest() != self.__dict_hash:
+            raise ValueError(f'The zstd dictionary of vault {self.__file_name} does not match its metadata')
+        return dictionary
+
+    @contextmanager
+    def __open_data(self) -> Iterator[IO[bytes]]:
+        # Mirror of VaultWriter: vault member | gpg | zstd.
+        dictionary = self.__load_dictionary()
+        gpg_process = gpg.decrypt(subprocess.PIPE, self.__password)
+        data_member = self.__tarball.getmember(op.join(_VAULT_ROOT_PREFIX, _VAULT_DATA_FILE))
+        # gpg is fed from a thread while its output is decompressed here, so neither side of the pipe stalls.
+        feeder = Thread(target=self.__feed, args=(data_member, gpg_process.stdin))
+        feeder.start()
+        try:
+            with zstd.decompress_stream(gpg_process.stdout, dictionary=dictionary) as data:
+                yield data
+                # Drain whatever the reader left behind, e.g. tar padding, so gpg can finish writing.
+                while data.read(utils.COPY_BUFFER_SIZE):
+                    pass
+        finally:
+            gpg_process.stdout.close()
+            feeder.join()
+            gpg_process.wait()
+        utils.wait_process(gpg_process)
+
+    def __data(self) -> utils.TarFile:
+        if self.__data_tarball is None:
+            log.info('Decrypting and decompressing data tarball')
+            data_tar_path = op.join(self.__tmp_dir.name, f'{_VAULT_DATA_PREFIX}.tar')
+            with self.__open_data() as data, open(data_tar_path, 'wb') as data_file:
+                shutil.copyfileobj(data, data_file, utils.COPY_BUFFER_SIZE)
+            self.__data_tarball = utils.TarFile(data_tar_path, mode='r')
+        return self.__data_tarball
 
     @property
     def type(self) -> VaultType:
@@ -246,7 +431,16 @@ class VaultReader:
 
     @property
     def hash_value(self) -> str:
-        return self.__hash_value
+        return self.digest(_HASH_ALG)
+
+    def digest(self, algorithm: str) -> str:
+        if algorithm not in self.__hash_values:
+            hash_value = _read_hash_sidecar(self.__file_name, self.__vault_file, algorithm)
+            if hash_value is None:
+                self.__vault_file.seek(0)
+                hash_value = utils.hash_file(self.__vault_file, algorithm)
+            self.__hash_values[algorithm] = hash_value
+        return self.__hash_values[algorithm]
 
     @property
     def file_name(self) -> str:
@@ -257,50 +451,96 @@ class VaultReader:
         return self.__dir_state
 
     @property
-    def sigs(self) -> dict[str, bytes]:
+    def sigs(self) -> dict[str, memoryview]:
+        if self.__sigs is None:
+            self.__sigs = _unpack_sigs(self.__decrypt(_VAULT_SIG_FILE))
         return self.__sigs
 
     @property
-    def previous(self) -> Optional[tuple[str, str]]:
+    def previous(self) -> Optional[tuple[str, str, str]]:
         return self.__previous_vault
 
     def __enter__(self):
         return self
 
     def close(self):
-        self.__data_tarball.close()
+        if self.__data_tarball is not None:
+            self.__data_tarball.close()
         self.__tmp_dir.cleanup()
         self.__tarball.close()
+        self.__vault_file.close()
         if self.__data_unfold is not None:
             self.__data_unfold.cleanup()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
-    def unfold(self):
-        if self.__data_unfold is not None:
+    def __unfold_dir(self) -> str:
+        if self.__data_unfold is None:
+            self.__data_unfold = TemporaryDirectory()
+        return self.__data_unfold.name
+
+    def unfold_all(self):
+        if self.__unfolded_all:
             return
-        self.__data_unfold = TemporaryDirectory()
-        self.__data_tarball.extractall(path=self.__data_unfold.name)
+        unfold_dir = self.__unfold_dir()
+        self.__unfolded_all = True
+        if self.__data_tarball is not None:
+            self.__data_tarball.extractall(path=unfold_dir)
+            return
+        # Extract straight from the decryption pipeline, so data.tar is never written out.
+        log.info('Decrypting, decompressing and unpacking data tarball')
+        with self.__open_data() as data, utils.TarFile.open(fileobj=data, mode='r|') as data_tarball:
+            data_tarball.extractall(path=unfold_dir)
+
+    def get_path(self, prefix: str, file: str) -> str:
+        """Path of a data file on disk, for handing to other processes. Only that file is extracted."""
+        if prefix != _VAULT_ADD_PREFIX and prefix != _VAULT_UPDATE_PREFIX:
+            raise ValueError(f'Invalid prefix {prefix}')
+        name = op.join(_VAULT_DATA_PREFIX, prefix, file)
+        path = op.join(self.__unfold_dir(), name)
+        if not self.__unfolded_all and not op.exists(path):
+            self.__data().extract(name, path=self.__unfold_dir())
+        return path
 
     def get(self, prefix: str, file: str) -> BytesIO | IO[bytes] | None:
         if prefix != _VAULT_ADD_PREFIX and prefix != _VAULT_UPDATE_PREFIX:
             raise ValueError(f'Invalid prefix {prefix}')
+        name = op.join(_VAULT_DATA_PREFIX, prefix, file)
         if self.__data_unfold is not None:
-            return open(op.join(self.__data_unfold.name, _VAULT_DATA_PREFIX, prefix, file), 'rb')
-        else:
-            return self.__data_tarball.extractfile(op.join(_VAULT_DATA_PREFIX, prefix, file))
+            path = op.join(self.__data_unfold.name, name)
+            if self.__unfolded_all or op.exists(path):
+                return open(path, 'rb')
+        return self.__data().extractfile(name)
 
 
 def create_vault(vault_dir: str, backup_dir: str, password: str) -> VaultWriter:
-    result = VaultWriter(vault_dir, backup_dir, password)
+    # One walk of the backup directory feeds both the file list here and the state saved by VaultWriter.close.
+    dir_state = DirState(Dir(backup_dir))
+    result = VaultWriter(vault_dir, backup_dir, password, dir_state=dir_state)
     log.info(f'Creating vault {result.id} in {vault_dir}')
-    for dirpath, _, filenames in os.walk(backup_dir):
-        for filename in filenames:
-            result.create(op.join(dirpath, filename))
+    files = dir_state.state['files']
+    # Signatures are CPU-bound and independent, so compute them on every core and only add to the tarball here.
+    create = result.create
+    with ProcessPoolExecutor() as executor:
+        sigs = executor.map(_signature, [op.join(backup_dir, file) for file in files], chunksize=32)
+        for file, sig in zip(files, sigs):
+            create(file, sig)
     return result
 
 
+def train_vault_dict(vault_dir: str, sample_dir: str, password: str):
+    log.info(f'Training zstd dictionary from {sample_dir} into {vault_dir}')
+    encrypted = gnupg.GPG().encrypt(zstd.train(sample_dir), recipients=None, passphrase=password,
+                                    symmetric=_DEFAULT_GPG_ALG, armor=False)
+    if not encrypted.ok:
+        raise ValueError(f'Failed to encrypt the zstd dictionary: {encrypted.status}')
+    # Write under a temporary name first, so a vault being written never reads a truncated dictionary.
+    with NamedTemporaryFile(dir=vault_dir, prefix=f'.{_VAULT_DICT_FILE}.', delete=False) as tmp:
+        tmp.write(encrypted.data)
+    os.replace(tmp.name, op.join(vault_dir, _VAULT_DICT_FILE))
+
+
 def open_vault(vault_file: str, password: str) -> VaultReader:
     log.info(f'Opening vault file {vault_file}')
     return VaultReader(vault_file, password)
@@ -308,21 +548,47 @@ def open_vault(vault_file: str, password: str) -> VaultReader:
 
 def increment_vault(vault_dir: str, last_vault_file: str, password: str, backup_dir: str) -> VaultWriter:
     with open_vault(op.join(vault_dir, last_vault_file), password) as last_vault:
+        current_state = DirState(Dir(backup_dir))
         current_vault = VaultWriter(vault_dir, backup_dir, password,
-                                    (last_vault_file, last_vault.hash_value, last_vault.sigs, last_vault.data_files))
+                                    (last_vault_file, last_vault.hash_value, last_vault.sigs, last_vault.data_files),
+                                    dir_state=current_state)
         log.info(f'Creating updated vault {current_vault.id} from {last_vault.id} in {vault_dir}')
-        backup_dir = Dir(backup_dir)
-        current_state = DirState(backup_dir)
         diff = current_state - last_vault.dir_state
-        for file in diff['created']:
-            current_vault.create(file)
-        for file in diff['updated']:
-            current_vault.update(file)
+        # As in create_vault, the new signatures are computed on every core while deltas are added here.
+        with ProcessPoolExecutor() as executor:
+            created_sigs = executor.map(_signature, [op.join(backup_dir, file) for file in diff['created']],
+                                        chunksize=32)
+            updated_sigs = executor.map(_signature, [op.join(backup_dir, file) for file in diff['updated']],
+                                        chunksize=32)
+            create = current_vault.create
+            for file, sig in zip(diff['created'], created_sigs):
+                create(file, sig)
+            update = current_vault.update
+            for file, sig in zip(diff['updated'], updated_sigs):
+                update(file, sig)
+        delete = current_vault.delete
         for file in diff['deleted']:
-            current_vault.delete(file)
+            delete(file)
     return current_vault
 
 
+def _patch(path: str, delta_path: str):
+    # Patch into a uniquely named sibling and rename it over the original, so the file is never half written
+    # and no other backed-up file can be clobbered by the temporary name.
+    with NamedTemporaryFile(dir=op.dirname(path), prefix=f'.{op.basename(path)}.', delete=False) as new_file:
+        new_path = new_file.name
+        try:
+            with open(path, 'rb') as f, open(delta_path, 'rb') as update_patch:
+                pyrsync.patch(f, update_patch, new_file)
+        except BaseException:
+            new_file.close()
+            os.unlink(new_path)
+            raise
+    # The temporary file is created private; keep the mode the working copy had.
+    shutil.copymode(path, new_path)
+    os.replace(new_path, path)
+
+
 class _WorkingDir:
     def __init__(self, base_backup: VaultReader, output_dir: str):
         if base_backup.type != VaultType.FULL:
@@ -331,14 +597,17 @@ class _WorkingDir:
         self.__working_dir = TemporaryDirectory()
 
         log.info(f'Unpacking base backup {base_backup.file_name}')
-        self.__base_backup.unfold()
+        self.__base_backup.unfold_all()
         self.__current_backup = self.__base_backup
 
+        working_dir = self.__working_dir.name
+        base_file_name = self.__base_backup.file_name
+        get = self.__base_backup.get
         for f in self.current_data_files:
-            log.info(f'Copying data file {f} from {self.__base_backup.file_name}')
-            with open(op.join(self.__working_dir.name, f), 'wb') as file:
-                with self.__current_backup.get(_VAULT_ADD_PREFIX, f) as created_file:
-                    file.write(created_file.read())
+            log.info(f'Copying data file {f} from {base_file_name}')
+            with open(op.join(working_dir, f), 'wb') as file:
+                with get(_VAULT_ADD_PREFIX, f) as created_file:
+                    utils.copyfileobj_to_end(created_file, file)
 
         self.__output_dir = output_dir
 
@@ -351,7 +620,8 @@ class _WorkingDir:
             raise ValueError('New vault must be an incremental vault')
 
         log.info(f'Unpacking incremental backup {new_vault.file_name}')
-        new_vault.unfold()
+        # Everything in an incremental vault is a created or updated file the patch needs.
+        new_vault.unfold_all()
 
         new_state = new_vault.dir_state
 
@@ -365,18 +635,18 @@ class _WorkingDir:
             log.info(f'Copying file {file} from {new_vault.file_name}')
             with open(op.join(self.__working_dir.name, file), 'wb') as f:
                 with new_vault.get(_VAULT_ADD_PREFIX, file) as created_file:
-                    f.write(created_file.read())
-
-        for file in diff['updated']:
-            log.info(f'Updating file {file} from {new_vault.file_name}')
-            with open(op.join(self.__working_dir.name, file), 'r+b') as f:
-                with BytesIO() as tmp:
-                    with new_vault.get(_VAULT_UPDATE_PREFIX, file) as update_patch:
-                        pyrsync.patch(f, update_patch, tmp)
-                        tmp.seek(0)
-                        f.truncate(0)
-                        f.seek(0)
-                        f.write(tmp.read())
+                    utils.copyfileobj_to_end(created_file, f)
+
+        if diff['updated']:
+            paths = []
+            delta_paths = []
+            for file in diff['updated']:
+                log.info(f'Updating file {file} from {new_vault.file_name}')
+                paths.append(op.join(self.__working_dir.name, file))
+                delta_paths.append(new_vault.get_path(_VAULT_UPDATE_PREFIX, file))
+            # Files are patched independently of each other, so spread them over every core.
+            with ProcessPoolExecutor() as executor:
+                list(executor.map(_patch, paths, delta_paths))
 
         self.__current_backup = new_vault
 
@@ -393,7 +663,7 @@ class _WorkingDir:
         return self.__current_backup.data_files
 
     @property
-    def current_sigs(self) -> dict[str, bytes]:
+    def current_sigs(self) -> dict[str, memoryview]:
         return self.__current_backup.sigs
 
     def __enter__(self):
@@ -419,9 +689,9 @@ def expand_vault(vault_dir: str, vault_file: str, password: str, target_dir: str
         working_list = [target_vault]
         tail = working_list[-1]
         while tail.type != VaultType.FULL:
-            previous_vault, previous_hash = tail.previous
+            previous_vault, previous_hash, previous_hash_algo = tail.previous
             to_add = open_vault(op.join(vault_dir, previous_vault), password)
-            if to_add.hash_value != previous_hash:
+            if to_add.digest(previous_hash_algo) != previous_hash:
                 raise ValueError(f'Hash mismatch for {previous_vault} as previous vault of {tail.file_name}')
             working_list.append(to_add)
             tail = working_list[-1]
@@ -1,11 +1,48 @@
-import subprocess
+import os
+from typing import IO, Optional
+
+import pyzstd
 
 DEFAULT_COMPRESS_LEVEL = 7
+LONG_WINDOW_LOG = 27
+DEFAULT_DICT_SIZE = 65536
+
+
+def _load_dict(dictionary: Optional[bytes]) -> Optional[pyzstd.ZstdDict]:
+    if dictionary is None:
+        return None
+    return pyzstd.ZstdDict(dictionary)
+
+
+def _compress_option(compress_level: int) -> dict:
+    return {pyzstd.CParameter.compressionLevel: compress_level,
+            pyzstd.CParameter.nbWorkers: os.cpu_count() or 1,
+            pyzstd.CParameter.windowLog: LONG_WINDOW_LOG,
+            pyzstd.CParameter.enableLongDistanceMatching: 1}
+
+
+def _decompress_option() -> dict:
+    return {pyzstd.DParameter.windowLogMax: LONG_WINDOW_LOG}
+
+
+def compress_stream(dst: IO[bytes], compress_level: int = DEFAULT_COMPRESS_LEVEL,
+                    dictionary: Optional[bytes] = None) -> pyzstd.ZstdFile:
+    """Open a writable file that compresses everything written to it into `dst`, using all cores."""
+    return pyzstd.ZstdFile(dst, mode='wb', level_or_option=_compress_option(compress_level),
+                           zstd_dict=_load_dict(dictionary))
 
 
-def compress(src: str, dst: str, compress_level: int = DEFAULT_COMPRESS_LEVEL):
-    subprocess.run(['zstd', f'-{compress_level}', src, '-o', dst], check=True)
+def decompress_stream(src: IO[bytes], dictionary: Optional[bytes] = None) -> pyzstd.ZstdFile:
+    """Open a readable file that decompresses `src` as it is read."""
+    return pyzstd.ZstdFile(src, mode='rb', level_or_option=_decompress_option(), zstd_dict=_load_dict(dictionary))
 
 
-def decompress(src: str, dst: str):
-    subprocess.run(['zstd', '-d', src, '-o', dst], check=True)
+def train(sample_dir: str, compress_level: int = DEFAULT_COMPRESS_LEVEL, dict_size: int = DEFAULT_DICT_SIZE) -> bytes:
+    """Train a dictionary on the files under `sample_dir` and return its content."""
+    samples = []
+    for root, _, files in os.walk(sample_dir):
+        for file in files:
+            with open(os.path.join(root, file), 'rb') as f:
+                samples.append(f.read())
+    zstd_dict = pyzstd.finalize_dict(pyzstd.train_dict(samples, dict_size), samples, dict_size, compress_level)
+    return zstd_dict.dict_content